@@ -2,9 +2,17 @@
 # Simple Python Flask server to run the audio processing APIs
 # Place this file in your backend directory and run: python app.py
 
+import io
 import os
 import sys
 import json
+import uuid
+import atexit
+import shutil
+import tempfile
+import threading
+
+import xxhash
 
 # Force CPU-only execution for PyTorch/Demucs
 os.environ['CUDA_VISIBLE_DEVICES'] = ''
@@ -12,17 +20,164 @@ os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
 
 sys.path.insert(0, os.path.dirname(__file__))
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 
-from process_stems import split_audio
-from analyze_tempo import analyze_tempo
+from process_stems import split_audio, load_model, find_stem, STEM_MIMETYPES
+from analyze_tempo import analyze_tempo, warm_up as warm_up_analysis, ANALYSIS_VERSION
 
 app = Flask(__name__)
 
 # Enable CORS for all routes
 CORS(app, resources={r"/api/*": {"origins": "*"}})
 
+STEM_NAMES = ['vocals', 'drums', 'bass', 'other']
+
+# Stem jobs run one Demucs pass at a time; up to STEM_QUEUE_SIZE more may wait
+# their turn and anything beyond that is rejected with a 503. These are
+# per-process thread primitives: the gthread worker serves concurrent requests
+# on threads, and nothing is left held by a worker that gets killed.
+STEM_QUEUE_SIZE = int(os.environ.get('STEM_QUEUE_SIZE', 1))
+STEM_JOB_SLOTS = threading.BoundedSemaphore(1 + STEM_QUEUE_SIZE)
+STEM_JOB_LOCK = threading.Lock()
+
+class StemQueueFull(Exception):
+    pass
+
+# Read size when streaming stem files back to the client
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+def stream_stems(stem_files, boundary):
+    """
+    Yield stem files as the parts of a multipart/mixed body
+    Each part carries the stem name in its Content-Disposition header
+    """
+    for stem_name, stem_file, stem_format in stem_files:
+        headers = (
+            f"--{boundary}\r\n"
+            f"Content-Type: {STEM_MIMETYPES[stem_format]}\r\n"
+            f"Content-Disposition: attachment; name=\"{stem_name}\"; filename=\"{stem_name}.{stem_format}\"\r\n"
+            f"Content-Length: {os.path.getsize(stem_file)}\r\n"
+            f"\r\n"
+        )
+        yield headers.encode('utf-8')
+        with open(stem_file, 'rb') as f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode('utf-8')
+
+# Upload formats libsndfile decodes straight from memory; anything else (e.g.
+# mp3/m4a via ffmpeg/audioread) goes through a temp file
+IN_MEMORY_FORMATS = {'.wav', '.flac', '.ogg'}
+
+def pick_temp_root(min_free_bytes=1 << 30):
+    """
+    Return /dev/shm when it is a tmpfs with room for a job's files, else None
+    (the system temp dir). Keeps scratch audio in RAM instead of on disk, but
+    avoids the small default /dev/shm in containers.
+    """
+    try:
+        stats = os.statvfs('/dev/shm')
+    except (AttributeError, OSError):
+        return None
+    return '/dev/shm' if stats.f_bavail * stats.f_frsize >= min_free_bytes else None
+
+TEMP_ROOT = pick_temp_root()
+
+# Scratch directory shared by all requests in this process tree; each job gets
+# its own subdirectory. Only the process that created it removes it at exit,
+# so gunicorn workers forked from a preloaded master don't delete it when
+# they are recycled.
+WORKER_TMP = tempfile.mkdtemp(prefix='openarms-', dir=TEMP_ROOT)
+_WORKER_TMP_OWNER = os.getpid()
+
+def _remove_worker_tmp():
+    if os.getpid() == _WORKER_TMP_OWNER:
+        shutil.rmtree(WORKER_TMP, ignore_errors=True)
+
+atexit.register(_remove_worker_tmp)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def sweep_orphaned_job_dirs():
+    """
+    Remove job directories left behind by dead workers
+    A worker that is SIGKILLed (timeout, OOM killer) never runs its cleanup, so
+    its uploads and stems would otherwise sit in WORKER_TMP (possibly RAM)
+    until redeploy. Job dirs are named <pid>-<uuid>; only dirs whose pid is no
+    longer running are removed, so a worker still finishing requests during a
+    graceful restart keeps its files.
+    """
+    try:
+        entries = os.listdir(WORKER_TMP)
+    except OSError:
+        return
+    for entry in entries:
+        pid, _, _ = entry.partition('-')
+        if pid.isdigit() and not _pid_alive(int(pid)):
+            print(f"Removing orphaned job dir: {entry}")
+            shutil.rmtree(os.path.join(WORKER_TMP, entry), ignore_errors=True)
+
+def make_job_dir():
+    """Create and return a fresh per-request directory under WORKER_TMP"""
+    sweep_orphaned_job_dirs()
+    job_dir = os.path.join(WORKER_TMP, f'{os.getpid()}-{uuid.uuid4().hex}')
+    os.makedirs(job_dir)
+    return job_dir
+
+# Tempo analysis results, keyed by analysis version and a hash of the
+# uploaded audio bytes
+TEMPO_CACHE_DIR = os.environ.get(
+    'TEMPO_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'openarms-tempo-cache')
+)
+
+def load_cached_tempo(key):
+    """Return the cached analysis result for key, or None"""
+    try:
+        with open(os.path.join(TEMPO_CACHE_DIR, f'{key}.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_cached_tempo(key, result):
+    """Write an analysis result to the cache atomically (temp file + rename)"""
+    try:
+        os.makedirs(TEMPO_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=TEMPO_CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(result, f)
+        os.replace(tmp_path, os.path.join(TEMPO_CACHE_DIR, f'{key}.json'))
+    except OSError as e:
+        print(f"WARNING: Failed to cache tempo result: {e}")
+
+def warm_up():
+    """
+    Load the Demucs model and warm librosa before serving requests
+    With gunicorn --preload this runs once in the master process and forked
+    workers inherit the loaded state copy-on-write. Demucs inference itself is
+    not warmed here: running torch's thread pool before forking can hang
+    the workers.
+    """
+    try:
+        load_model()
+        warm_up_analysis()
+    except Exception as e:
+        # Requests will retry the load; stems fall back to pydub if it fails
+        print(f"WARNING: Warm-up failed: {e}")
+
+warm_up()
+
 @app.route('/')
 def health():
     return jsonify({'status': 'ok', 'message': 'Backend is running'}), 200
@@ -32,62 +187,80 @@ def stems():
     try:
         print("=== Stem separation request received ===")
         
-        if 'file' not in request.files:
-            print("ERROR: No file in request")
-            return jsonify({'error': 'No file uploaded'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            print("ERROR: Empty filename")
-            return jsonify({'error': 'No file selected'}), 400
-        
-        print(f"Processing file: {file.filename}")
-        
-        import base64
-        import tempfile
-        
-        # Save temp file in a safe location
-        with tempfile.TemporaryDirectory() as temp_dir:
-            input_path = os.path.join(temp_dir, file.filename)
-            output_dir = os.path.join(temp_dir, 'stems')
-            
-            print(f"Saving to: {input_path}")
-            file.save(input_path)
-            
-            # Verify file was saved
-            if not os.path.exists(input_path):
-                raise Exception("Failed to save uploaded file")
-            
-            file_size = os.path.getsize(input_path)
-            print(f"File saved successfully: {file_size} bytes")
-            
-            # Process
-            print("Starting stem separation...")
-            result = split_audio(input_path, output_dir)
-            print(f"Separation complete. Success: {result}")
-            
-            # Read and encode stems as base64
-            stems_data = {}
-            missing_stems = []
+        # Admit or reject before touching the upload, so a rejected request
+        # never parses or saves its body into scratch space
+        if not STEM_JOB_SLOTS.acquire(block=False):
+            raise StemQueueFull("Server busy, too many stem jobs queued. Try again shortly")
+        try:
+            if 'file' not in request.files:
+                print("ERROR: No file in request")
+                return jsonify({'error': 'No file uploaded'}), 400
             
-            for stem_name in ['vocals', 'drums', 'bass', 'other']:
-                stem_file = os.path.join(output_dir, f'{stem_name}.wav')
-                if os.path.exists(stem_file):
-                    stem_size = os.path.getsize(stem_file)
-                    print(f"Reading {stem_name}.wav ({stem_size} bytes)")
-                    with open(stem_file, 'rb') as f:
-                        stems_data[stem_name] = base64.b64encode(f.read()).decode('utf-8')
-                    print(f"Encoded {stem_name}: {len(stems_data[stem_name])} chars")
-                else:
-                    missing_stems.append(stem_name)
-                    print(f"WARNING: Missing {stem_name}.wav")
+            file = request.files['file']
+            if file.filename == '':
+                print("ERROR: Empty filename")
+                return jsonify({'error': 'No file selected'}), 400
             
-            if missing_stems:
-                raise Exception(f"Missing stems: {', '.join(missing_stems)}")
+            print(f"Processing file: {file.filename}")
             
-            print("=== Stem separation successful ===")
-            return jsonify(stems_data)
+            # Save temp file in a safe location; it's removed once the response
+            # has been streamed, or right away if anything fails before that
+            temp_dir = make_job_dir()
+            try:
+                input_path = os.path.join(temp_dir, file.filename)
+                output_dir = os.path.join(temp_dir, 'stems')
+                
+                print(f"Saving to: {input_path}")
+                file.save(input_path)
+                
+                # Verify file was saved
+                if not os.path.exists(input_path):
+                    raise Exception("Failed to save uploaded file")
+                
+                file_size = os.path.getsize(input_path)
+                print(f"File saved successfully: {file_size} bytes")
+                
+                # Process
+                print("Starting stem separation...")
+                with STEM_JOB_LOCK:
+                    result = split_audio(input_path, output_dir)
+                print(f"Separation complete. Success: {result}")
+                
+                # Collect stems to stream back
+                stem_files = []
+                missing_stems = []
+                
+                for stem_name in STEM_NAMES:
+                    found = find_stem(output_dir, stem_name)
+                    if found:
+                        stem_file, stem_format = found
+                        print(f"Streaming {stem_name}.{stem_format} ({os.path.getsize(stem_file)} bytes)")
+                        stem_files.append((stem_name, stem_file, stem_format))
+                    else:
+                        missing_stems.append(stem_name)
+                        print(f"WARNING: Missing {stem_name} stem")
+                
+                if missing_stems:
+                    raise Exception(f"Missing stems: {', '.join(missing_stems)}")
+                
+                boundary = uuid.uuid4().hex
+                response = Response(
+                    stream_stems(stem_files, boundary),
+                    content_type=f'multipart/mixed; boundary={boundary}'
+                )
+                response.call_on_close(lambda: shutil.rmtree(temp_dir, ignore_errors=True))
+                
+                print("=== Stem separation successful ===")
+                return response
+            except Exception:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                raise
+        finally:
+            STEM_JOB_SLOTS.release()
             
+    except StemQueueFull as e:
+        print(f"ERROR: {str(e)}")
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         import traceback
         print(f"ERROR in /api/stems: {str(e)}")
@@ -104,17 +277,33 @@ def tempo():
         if file.filename == '':
             return jsonify({'error': 'No file selected'}), 400
         
-        import tempfile
+        audio_bytes = file.read()
         
-        # Save temp file in a safe location
-        with tempfile.TemporaryDirectory() as temp_dir:
-            audio_path = os.path.join(temp_dir, file.filename)
-            file.save(audio_path)
-            
-            # Process
-            result = analyze_tempo(audio_path)
-            
-            return jsonify(result)
+        # Repeat uploads of the same audio are served from the cache
+        cache_key = f'v{ANALYSIS_VERSION}-{xxhash.xxh3_128_hexdigest(audio_bytes)}'
+        cached = load_cached_tempo(cache_key)
+        if cached is not None:
+            print(f"Tempo cache hit: {cache_key}")
+            return jsonify(cached)
+        
+        # Process
+        if os.path.splitext(file.filename)[1].lower() in IN_MEMORY_FORMATS:
+            result = analyze_tempo(io.BytesIO(audio_bytes), file.filename)
+        else:
+            # Save temp file in a safe location
+            temp_dir = make_job_dir()
+            try:
+                audio_path = os.path.join(temp_dir, file.filename)
+                with open(audio_path, 'wb') as f:
+                    f.write(audio_bytes)
+                result = analyze_tempo(audio_path)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        
+        if result.get('success'):
+            save_cached_tempo(cache_key, result)
+        
+        return jsonify(result)
     except Exception as e:
         import traceback
         print(f"ERROR in /api/tempo: {str(e)}")